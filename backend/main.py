@@ -1,18 +1,39 @@
 """
 FreeForm Collaborative Whiteboard - Backend Server
 """
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Response, WebSocket, WebSocketDisconnect
+from websockets.exceptions import ConnectionClosed
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from typing import List, Dict, Any
-import json
 import asyncio
+import base64
+import hashlib
+import os
+import queue
+import re
+import struct
+import threading
+from array import array
 from pathlib import Path
+from collections import defaultdict, deque
 from datetime import datetime
-from pydantic import BaseModel
+import msgspec
+import orjson
 import uuid
+import zstandard as zstd
 
-app = FastAPI(title="FreeForm Whiteboard")
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse that serializes via orjson instead of stdlib json"""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+app = FastAPI(title="FreeForm Whiteboard", default_response_class=ORJSONResponse)
 
 # CORS middleware for local network access
 app.add_middleware(
@@ -24,238 +45,732 @@ app.add_middleware(
 )
 
 
-# Data models
-class DrawEvent(BaseModel):
+# Data models (msgspec structs: slots-based, validate on decode without
+# the Pydantic per-field overhead)
+class DrawEvent(msgspec.Struct, omit_defaults=True):
     type: str  # 'draw', 'shape', 'erase', 'clear', 'laser'
     tool: str  # 'pen', 'line', 'rectangle', 'circle', 'arrow', 'eraser', 'text', 'object-eraser', 'laser', 'lasso'
     color: str
     lineWidth: int
     lineType: str  # 'solid', 'dashed'
-    points: List[Dict[str, float]]
+    # Interleaved [x0, y0, x1, y1, ...]: one contiguous float buffer per
+    # stroke instead of a Python dict per point, and half the JSON size
+    points: array
     timestamp: float
     id: str
     clientId: str | None = None
     text: str | None = None
     fontSize: int | None = None
     imageData: str | None = None
+    imageRef: str | None = None  # content-addressed file under images/
     imageWidth: int | None = None
     imageHeight: int | None = None
 
 
-class CanvasState(BaseModel):
-    elements: List[DrawEvent] = []
+class CanvasState(msgspec.Struct):
+    elements: List[DrawEvent] = msgspec.field(default_factory=list)
     lastModified: str = ""
 
 
+# Incoming websocket envelopes as a tagged union: msgspec dispatches on
+# the "type" field in C, so one decode yields a fully typed struct
+class _EnvelopeBase(msgspec.Struct, tag_field="type", tag=str.lower):
+    pass
+
+
+class Draw(_EnvelopeBase):
+    data: DrawEvent
+
+
+class Laser(_EnvelopeBase):
+    # Laser strokes are ephemeral (broadcast-only, never stored), so the
+    # payload is kept as raw bytes and spliced into the outgoing frame
+    # without any per-field validation
+    data: msgspec.Raw
+
+
+class Delete(_EnvelopeBase):
+    elementId: str | None = None
+
+
+class Clear(_EnvelopeBase):
+    pass
+
+
+class Undo(_EnvelopeBase):
+    pass
+
+
+Envelope = Draw | Laser | Delete | Clear | Undo
+
+
+def _enc_hook(obj: Any) -> Any:
+    if isinstance(obj, array):
+        return obj.tolist()
+    raise NotImplementedError(f"Cannot encode {type(obj)}")
+
+
+def _dec_hook(typ: type, obj: Any) -> Any:
+    if typ is array:
+        if obj and isinstance(obj[0], dict):
+            # Legacy [{'x': ..., 'y': ...}] form from old snapshots/logs
+            flat = array('f')
+            for point in obj:
+                try:
+                    flat.append(point["x"])
+                    flat.append(point["y"])
+                except (KeyError, TypeError) as e:
+                    # Must be a ValidationError: msgspec only translates
+                    # TypeError/ValueError from hooks, and a raw KeyError
+                    # would escape the decode handlers
+                    raise msgspec.ValidationError(f"Invalid point: {point!r}") from e
+            return flat
+        return array('f', obj)
+    raise NotImplementedError(f"Cannot decode {typ}")
+
+
+# Shared websocket encoders/decoders (reused so buffers stay warm).
+# Browsers speak JSON; native clients may negotiate the msgpack subprotocol.
+_encoder = msgspec.json.Encoder(enc_hook=_enc_hook)
+_decoder = msgspec.json.Decoder()
+_mp_encoder = msgspec.msgpack.Encoder(enc_hook=_enc_hook)
+_mp_decoder = msgspec.msgpack.Decoder()
+_envelope_decoder = msgspec.json.Decoder(Envelope, dec_hook=_dec_hook)
+_mp_envelope_decoder = msgspec.msgpack.Decoder(Envelope, dec_hook=_dec_hook)
+
+# Snapshot compression: level 3 is near-memcpy speed and the repetitive
+# JSON (field names, colors) compresses several-x. Only ever used from
+# the writer thread.
+_zstd_compressor = zstd.ZstdCompressor(level=3)
+_zstd_decompressor = zstd.ZstdDecompressor()
+
+# How long to coalesce outgoing events before flushing one batch frame.
+# 12ms sits just under the browser's 16ms frame budget.
+BROADCAST_FLUSH_INTERVAL = 0.012
+
+# Force a full snapshot once this many events accumulate in the log,
+# even if the board never goes idle
+SNAPSHOT_EVERY_EVENTS = 1000
+
+# Per-client send queue depth; a client that falls this far behind is
+# considered dead and dropped
+SEND_QUEUE_SIZE = 256
+
+# How many pre-serialized event frames to keep for reconnect resume;
+# clients further behind than this get a full snapshot
+EVENT_LOG_SIZE = 10000
+
+# Pasted images are stored out-of-band here and referenced by hash, so
+# megabyte-scale base64 blobs never ride along in snapshots or broadcasts
+IMAGES_DIR = Path("images")
+IMAGES_DIR.mkdir(exist_ok=True)
+
+_DATA_URL_RE = re.compile(r"data:image/(\w+);base64")
+
+
+def _externalize_image(draw_event: DrawEvent):
+    """Swap an inline base64 image for a content-addressed file reference"""
+    image_data = draw_event.imageData
+    if not image_data or not image_data.startswith("data:"):
+        return
+    header, _, b64 = image_data.partition(",")
+    match = _DATA_URL_RE.match(header)
+    if match is None:
+        return
+    try:
+        raw = base64.b64decode(b64)
+    except Exception as e:
+        print(f"Error decoding image data: {e}")
+        return
+    name = hashlib.blake2b(raw, digest_size=16).hexdigest() + "." + match.group(1)
+    path = IMAGES_DIR / name
+    if not path.exists():
+        path.write_bytes(raw)
+    draw_event.imageData = None
+    draw_event.imageRef = name
+
+
+class Client:
+    """One websocket connection plus its outbound send queue
+
+    Each client gets a private queue drained by its own consumer task,
+    so broadcast never awaits a send: one slow or stalled client can't
+    hold up fan-out to everyone else.
+    """
+    __slots__ = ("websocket", "wire", "queue", "consumer")
+
+    def __init__(self, websocket: WebSocket, wire: str):
+        self.websocket = websocket
+        self.wire = wire  # 'json' | 'msgpack'
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.consumer: asyncio.Task | None = None
+
+
 # Connection manager for WebSocket clients
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}  # clientId -> WebSocket
+        self.active_connections: Dict[str, Client] = {}  # clientId -> Client
         self.canvas_state = CanvasState()
-        self.persistence_file = Path("whiteboard_data.json")
+        self.persistence_file = Path("whiteboard_data.json.zst")
+        self.legacy_persistence_file = Path("whiteboard_data.json")
+        self.log_file = Path("whiteboard.log")
+        self._index: Dict[str, int] = {}  # element id -> position in elements list
+        self._tombstones = 0  # deleted slots left as None until compaction
+        self._snapshot_cache: Dict[str, bytes] = {}  # wire -> encoded init frame
+        self._client_history: Dict[str, deque] = defaultdict(deque)  # clientId -> element ids, for undo
+        # Monotonic mutation counter plus recent pre-serialized frames,
+        # so reconnecting clients can resume with deltas instead of a
+        # full snapshot. The epoch distinguishes server restarts.
+        self._seq = 0
+        self._epoch = uuid.uuid4().hex
+        self._event_log: deque = deque(maxlen=EVENT_LOG_SIZE)  # (seq, json bytes)
         self.load_state()
-        self.save_task = None
-        
+        # Append-only event log: per-event persistence is O(1) instead of
+        # rewriting the whole snapshot; truncated on every snapshot
+        self._log = open(self.log_file, "ab", buffering=0)
+        self._log_events_since_snapshot = 0
+        self._dirty_event = asyncio.Event()
+        self._saver_task = None
+        self._outbox: List[tuple] = []  # (message, exclude_client_id) awaiting flush
+        self._flush_handle = None
+        # Disk writes happen on a dedicated thread so the event loop never
+        # blocks on file I/O
+        self._save_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._save_pending = False
+        threading.Thread(target=self._writer_loop, daemon=True,
+                         name="whiteboard-writer").start()
+
+    def _invalidate_snapshot(self):
+        """Drop cached init frames after any canvas mutation"""
+        self._snapshot_cache.clear()
+
+    def _rebuild_index(self):
+        """Rebuild the id -> index map from the elements list"""
+        self._index = {el.id: i for i, el in enumerate(self.canvas_state.elements) if el is not None}
+
+    def _compact(self):
+        """Drop tombstoned slots and rebuild the index in one pass"""
+        if self._tombstones:
+            self.canvas_state.elements = [el for el in self.canvas_state.elements if el is not None]
+            self._tombstones = 0
+            self._rebuild_index()
+
     def load_state(self):
         """Load canvas state from disk"""
-        if self.persistence_file.exists():
+        try:
+            raw = None
+            if self.persistence_file.exists():
+                with open(self.persistence_file, 'rb') as f:
+                    raw = _zstd_decompressor.decompress(f.read())
+            elif self.legacy_persistence_file.exists():
+                # Uncompressed snapshot from before zstd; picked up once
+                # and rewritten as .zst on the next save
+                with open(self.legacy_persistence_file, 'rb') as f:
+                    raw = f.read()
+            if raw is not None:
+                self.canvas_state = msgspec.json.decode(raw, type=CanvasState,
+                                                        dec_hook=_dec_hook)
+                print(f"Loaded {len(self.canvas_state.elements)} elements from disk")
+        except Exception as e:
+            print(f"Error loading state: {e}")
+            self.canvas_state = CanvasState()
+        self._rebuild_index()
+        replayed = self._replay_log()
+        if replayed:
+            print(f"Replayed {replayed} events from log")
+
+    def _replay_log(self) -> int:
+        """Re-apply events logged since the last snapshot"""
+        if not self.log_file.exists():
+            return 0
+        with open(self.log_file, 'rb') as f:
+            data = f.read()
+        applied = 0
+        pos = 0
+        while pos + 4 <= len(data):
+            (length,) = struct.unpack_from(">I", data, pos)
+            pos += 4
+            if pos + length > len(data):
+                break  # torn tail from a crash mid-append; drop it
             try:
-                with open(self.persistence_file, 'r') as f:
-                    data = json.load(f)
-                    self.canvas_state = CanvasState(**data)
-                    print(f"Loaded {len(self.canvas_state.elements)} elements from disk")
-            except Exception as e:
-                print(f"Error loading state: {e}")
-                self.canvas_state = CanvasState()
-        
+                op = _mp_decoder.decode(data[pos:pos + length])
+                self._apply_op(op)
+            except (msgspec.DecodeError, msgspec.ValidationError) as e:
+                print(f"Error replaying log entry: {e}")
+                break
+            pos += length
+            applied += 1
+        return applied
+
+    def _apply_op(self, op: dict):
+        """Apply one logged mutation during replay (must stay idempotent)"""
+        kind = op.get("op")
+        if kind == "draw":
+            self.add_or_update_element(
+                msgspec.convert(op["data"], DrawEvent, dec_hook=_dec_hook))
+        elif kind == "delete":
+            self.delete_element(op["id"])
+        elif kind == "clear":
+            self.clear_canvas()
+
+    def record_event(self, message: dict) -> dict:
+        """Stamp a broadcast message with a seq and keep its encoded frame"""
+        self._seq += 1
+        message["seq"] = self._seq
+        self._event_log.append((self._seq, _encoder.encode(message)))
+        return message
+
+    def log_event(self, op: dict):
+        """Queue one mutation for the append-only log (never blocks)"""
+        payload = _mp_encoder.encode(op)
+        self._save_queue.put(("log", struct.pack(">I", len(payload)) + payload))
+        self._log_events_since_snapshot += 1
+        if self._log_events_since_snapshot >= SNAPSHOT_EVERY_EVENTS:
+            self.request_save()
+
     def save_state(self):
-        """Save canvas state to disk"""
+        """Save canvas state to disk (runs on the writer thread)"""
         try:
             self.canvas_state.lastModified = datetime.now().isoformat()
-            with open(self.persistence_file, 'w') as f:
-                json.dump(self.canvas_state.model_dump(), f, indent=2)
-            print(f"Saved {len(self.canvas_state.elements)} elements to disk")
+            # Snapshot live elements first: the event loop may append or
+            # tombstone concurrently, and a single list comprehension over
+            # the current list is safe under the GIL
+            state = CanvasState(
+                elements=[el for el in self.canvas_state.elements if el is not None],
+                lastModified=self.canvas_state.lastModified,
+            )
+            # Encode structs straight to JSON bytes; no builtins/dict
+            # intermediate (and no shared encoder: this runs off-loop)
+            buf = _zstd_compressor.compress(
+                msgspec.json.encode(state, enc_hook=_enc_hook))
+            # Write to a temp file, sync data to disk, then atomically
+            # replace: a crash mid-write can never corrupt the only copy
+            tmp = self.persistence_file.with_name(self.persistence_file.name + ".tmp")
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, buf)
+                os.fdatasync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp, self.persistence_file)
+            # Everything in the log is now covered by the snapshot
+            self._log.truncate(0)
+            self._log_events_since_snapshot = 0
+            print(f"Saved {len(state.elements)} elements to disk")
         except Exception as e:
             print(f"Error saving state: {e}")
-    
-    async def schedule_save(self):
-        """Debounced auto-save - saves 2 seconds after last change"""
-        if self.save_task:
-            self.save_task.cancel()
-        
-        async def delayed_save():
+
+    def request_save(self):
+        """Hand the next snapshot off to the writer thread (never blocks)"""
+        if not self._save_pending:
+            self._save_pending = True
+            self._save_queue.put(("snapshot", b""))
+
+    def _writer_loop(self):
+        """Writer thread: drain log appends and snapshots off the event loop"""
+        while True:
+            items = [self._save_queue.get()]
+            # Drain whatever else queued so log appends share one fdatasync
+            try:
+                while True:
+                    items.append(self._save_queue.get_nowait())
+            except queue.Empty:
+                pass
+            frames = b"".join(buf for kind, buf in items if kind == "log")
+            if frames:
+                self._log.write(frames)
+                os.fdatasync(self._log.fileno())
+            if any(kind == "snapshot" for kind, _ in items):
+                self._save_pending = False
+                self.save_state()
+
+    def start_background_tasks(self):
+        """Start the long-running saver task (needs a running loop)"""
+        if self._saver_task is None:
+            self._saver_task = asyncio.create_task(self._saver_loop())
+
+    def mark_dirty(self):
+        """Flag that state changed; the saver task snapshots after 2s quiet"""
+        self._dirty_event.set()
+
+    async def _saver_loop(self):
+        """Debounced auto-save without per-event Task churn
+
+        A single persistent task replaces the old cancel-and-recreate
+        pattern: each change is just an Event.set(), and a snapshot is
+        requested once the board has been quiet for 2 seconds.
+        """
+        while True:
+            await self._dirty_event.wait()
+            self._dirty_event.clear()
             await asyncio.sleep(2)
-            self.save_state()
-        
-        self.save_task = asyncio.create_task(delayed_save())
+            if self._dirty_event.is_set():
+                continue  # still changing; keep waiting for quiet
+            self.request_save()
     
     async def connect(self, websocket: WebSocket):
-        await websocket.accept()
+        # Native clients can negotiate msgpack frames via the subprotocol header
+        requested = websocket.headers.get("sec-websocket-protocol", "")
+        offered = [p.strip() for p in requested.split(",") if p.strip()]
+        wire = "msgpack" if "msgpack" in offered else "json"
+        await websocket.accept(subprotocol="msgpack" if wire == "msgpack" else None)
         # Generate unique client ID
         client_id = str(uuid.uuid4())
-        self.active_connections[client_id] = websocket
-        # Send current canvas state and client ID to new client
-        await websocket.send_json({
-            "type": "init",
-            "data": self.canvas_state.model_dump(),
-            "clientId": client_id
-        })
-        print(f"Client {client_id} connected. Total connections: {len(self.active_connections)}")
+        client = Client(websocket, wire)
+        self.active_connections[client_id] = client
+        client.consumer = asyncio.create_task(self._consume(client_id, client))
+        if not self._try_resume(client_id, client, websocket):
+            # Send current canvas state to the new client. The init frame
+            # is identical for every joiner, so reuse the cached bytes and
+            # follow up with a tiny per-client frame carrying the client ID.
+            self._compact()  # snapshot must not contain tombstoned slots
+            payload = self._snapshot_cache.get(wire)
+            if payload is None:
+                message = {
+                    "type": "init",
+                    "data": self.canvas_state,
+                    "seq": self._seq,
+                    "epoch": self._epoch,
+                }
+                payload = (_mp_encoder.encode(message) if wire == "msgpack"
+                           else _encoder.encode(message))
+                self._snapshot_cache[wire] = payload
+            self._enqueue(client_id, client, payload)
+        self.send_to(client_id, {"type": "clientId", "clientId": client_id})
+        print(f"Client {client_id} connected ({wire}). Total connections: {len(self.active_connections)}")
         return client_id
-    
+
+    def _try_resume(self, client_id: str, client: Client, websocket: WebSocket) -> bool:
+        """Replay deltas for a reconnecting client instead of the snapshot
+
+        The client echoes back the last seq it saw plus the server epoch;
+        if every missed frame is still in the event log, splice the
+        pre-serialized bytes into one batch frame. Returns False when a
+        full snapshot is needed (new client, restarted server, or the
+        client fell too far behind). JSON wire only: the frames are kept
+        as JSON bytes.
+        """
+        if client.wire != "json":
+            return False
+        if websocket.query_params.get("epoch") != self._epoch:
+            return False
+        try:
+            since = int(websocket.query_params.get("since", ""))
+        except ValueError:
+            return False
+        if since > self._seq:
+            return False
+        if since < self._seq:
+            if not self._event_log or self._event_log[0][0] > since + 1:
+                return False  # frames already rotated out of the log
+            frames = [buf for seq, buf in self._event_log if seq > since]
+            self._enqueue(client_id, client,
+                          b'{"type":"batch","events":[' + b",".join(frames) + b"]}")
+        print(f"Client {client_id} resumed from seq {since}")
+        return True
+
     def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
+        client = self.active_connections.pop(client_id, None)
+        if client is None:
+            return
+        if client.consumer is not None and client.consumer is not asyncio.current_task():
+            client.consumer.cancel()
+        self._client_history.pop(client_id, None)
         print(f"Client {client_id} disconnected. Total connections: {len(self.active_connections)}")
+
+    async def _consume(self, client_id: str, client: Client):
+        """Drain one client's send queue onto its websocket"""
+        try:
+            while True:
+                payload = await client.queue.get()
+                await client.websocket.send_bytes(payload)
+        except asyncio.CancelledError:
+            raise
+        except (WebSocketDisconnect, ConnectionClosed, RuntimeError):
+            # Connection died under us; reap it
+            self.disconnect(client_id)
+
+    def _enqueue(self, client_id: str, client: Client, payload: bytes):
+        """Queue bytes for one client; drop clients that can't keep up"""
+        try:
+            client.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            print(f"Client {client_id} send queue full, dropping connection")
+            self.disconnect(client_id)
+            asyncio.create_task(self._close_quietly(client.websocket))
+
+    async def _close_quietly(self, websocket: WebSocket):
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+    def send_to(self, client_id: str, message: dict):
+        """Queue a message for one client in its negotiated wire format"""
+        client = self.active_connections.get(client_id)
+        if client is None:
+            return
+        if client.wire == "msgpack":
+            self._enqueue(client_id, client, _mp_encoder.encode(message))
+        else:
+            self._enqueue(client_id, client, _encoder.encode(message))
     
+    def queue_broadcast(self, message: dict, exclude_client_id: str = None):
+        """Buffer a message for broadcast; flushed as one batch frame
+
+        Continuous pen strokes produce 60+ events/sec per client. Instead
+        of serializing and fanning out each one, coalesce everything that
+        arrives within BROADCAST_FLUSH_INTERVAL into a single frame.
+        """
+        self._outbox.append((message, exclude_client_id))
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                BROADCAST_FLUSH_INTERVAL,
+                lambda: asyncio.create_task(self._flush()))
+
+    async def _flush(self):
+        self._flush_handle = None
+        outbox, self._outbox = self._outbox, []
+        # Group by excluded sender so each group serializes exactly once
+        groups: Dict[str | None, List[dict]] = {}
+        for message, exclude in outbox:
+            groups.setdefault(exclude, []).append(message)
+        for exclude, messages in groups.items():
+            # Coalesce successive updates to the same element: only the
+            # latest version of a stroke needs to reach the other clients
+            latest_draw: Dict[str, int] = {}
+            coalesced: List[dict] = []
+            for message in messages:
+                if message.get("type") == "draw":
+                    pos = latest_draw.get(message["data"].id)
+                    if pos is not None:
+                        coalesced[pos] = message
+                        continue
+                    latest_draw[message["data"].id] = len(coalesced)
+                coalesced.append(message)
+            if len(coalesced) == 1:
+                await self.broadcast(coalesced[0], exclude_client_id=exclude)
+            else:
+                await self.broadcast({"type": "batch", "events": coalesced},
+                                     exclude_client_id=exclude)
+
     async def broadcast(self, message: dict, exclude_client_id: str = None):
-        """Broadcast message to all connected clients except the sender"""
-        disconnected = []
-        for client_id, connection in self.active_connections.items():
+        """Broadcast message to all connected clients except the sender
+
+        Only enqueues: the per-client consumer tasks do the actual sends,
+        and _enqueue reaps clients whose queues overflow.
+        """
+        # Serialize once per wire format; msgpack is only encoded if a
+        # msgpack client is actually connected
+        payload = _encoder.encode(message)
+        mp_payload = None
+        for client_id, client in list(self.active_connections.items()):
             if client_id != exclude_client_id:
-                try:
-                    await connection.send_json(message)
-                except:
-                    disconnected.append(client_id)
-        
-        # Clean up disconnected clients
-        for client_id in disconnected:
-            if client_id in self.active_connections:
-                del self.active_connections[client_id]
+                if client.wire == "msgpack":
+                    if mp_payload is None:
+                        mp_payload = _mp_encoder.encode(message)
+                    self._enqueue(client_id, client, mp_payload)
+                else:
+                    self._enqueue(client_id, client, payload)
     
     def add_or_update_element(self, element: DrawEvent):
         """Add or update drawing element in canvas state"""
-        # Check if element with this ID already exists
-        existing_index = None
-        for i, el in enumerate(self.canvas_state.elements):
-            if el.id == element.id:
-                existing_index = i
-                break
-        
+        self._invalidate_snapshot()
+        existing_index = self._index.get(element.id)
         if existing_index is not None:
             # Update existing element
             self.canvas_state.elements[existing_index] = element
         else:
             # Add new element
             self.canvas_state.elements.append(element)
-    
+            self._index[element.id] = len(self.canvas_state.elements) - 1
+            if element.clientId:
+                self._client_history[element.clientId].append(element.id)
+
     def delete_element(self, element_id: str) -> bool:
         """Delete element by ID from canvas state"""
-        initial_length = len(self.canvas_state.elements)
-        self.canvas_state.elements = [el for el in self.canvas_state.elements if el.id != element_id]
-        return len(self.canvas_state.elements) < initial_length
-    
+        idx = self._index.pop(element_id, None)
+        if idx is None:
+            return False
+        self._invalidate_snapshot()
+        # Tombstone the slot instead of rebuilding the whole list
+        self.canvas_state.elements[idx] = None
+        self._tombstones += 1
+        # Compact once tombstones exceed 25% of the list
+        if self._tombstones * 4 > len(self.canvas_state.elements):
+            self._compact()
+        return True
+
     def clear_canvas(self):
         """Clear all elements from canvas"""
+        self._invalidate_snapshot()
         self.canvas_state.elements = []
-    
+        self._index = {}
+        self._tombstones = 0
+        self._client_history.clear()
+
     def undo_for_client(self, client_id: str) -> str | None:
-        """Remove the last element created by the specified client"""
-        # Find the last element with this client ID
-        for i in range(len(self.canvas_state.elements) - 1, -1, -1):
-            if self.canvas_state.elements[i].clientId == client_id:
-                removed_element = self.canvas_state.elements.pop(i)
-                return removed_element.id
+        """Remove the last element created by the specified client
+
+        Pops ids off the client's own history deque instead of scanning
+        the whole elements list; ids already deleted by someone else are
+        skipped.
+        """
+        history = self._client_history.get(client_id)
+        while history:
+            element_id = history.pop()
+            if self.delete_element(element_id):
+                return element_id
         return None
 
 
 manager = ConnectionManager()
 
 
+@app.on_event("startup")
+async def startup():
+    # The manager is constructed at import time, before the event loop
+    # exists; the saver task has to start here
+    manager.start_background_tasks()
+
+
+# Pre-encoded body; the endpoint's response never changes
+_ROOT_BODY = orjson.dumps({"message": "FreeForm Whiteboard API", "status": "running"})
+
+
 @app.get("/")
 async def root():
-    return {"message": "FreeForm Whiteboard API", "status": "running"}
+    # Returning a Response directly skips FastAPI's jsonable_encoder pass
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 
 @app.get("/api/health")
 async def health():
-    return {
+    return Response(content=orjson.dumps({
         "status": "healthy",
         "connections": len(manager.active_connections),
-        "elements": len(manager.canvas_state.elements)
-    }
+        "elements": len(manager._index)
+    }), media_type="application/json")
+
+
+async def _handle_draw(envelope: Draw, client_id: str):
+    # Store the drawing event (already validated by the envelope decode)
+    draw_event = envelope.data
+    _externalize_image(draw_event)
+    manager.add_or_update_element(draw_event)
+    manager.log_event({"op": "draw", "data": draw_event})
+
+    # Broadcast to all other clients
+    manager.queue_broadcast(manager.record_event({
+        "type": "draw",
+        "data": draw_event
+    }), exclude_client_id=client_id)
+
+    # Flag for the debounced auto-save
+    manager.mark_dirty()
+
+
+async def _handle_laser(envelope: Laser, client_id: str):
+    # Laser events are broadcast but never saved. The raw payload bytes
+    # are in the sender's wire format; only decode them if a client on
+    # the other wire format needs a re-encode.
+    sender = manager.active_connections.get(client_id)
+    sender_wire = sender.wire if sender else "json"
+    data: Any = envelope.data
+    if any(client.wire != sender_wire
+           for cid, client in manager.active_connections.items()
+           if cid != client_id):
+        data = (_decoder if sender_wire == "json" else _mp_decoder).decode(data)
+    manager.queue_broadcast({
+        "type": "laser",
+        "data": data
+    }, exclude_client_id=client_id)
+
+
+async def _handle_delete(envelope: Delete, client_id: str):
+    element_id = envelope.elementId
+    if element_id and manager.delete_element(element_id):
+        manager.log_event({"op": "delete", "id": element_id})
+        manager.queue_broadcast(manager.record_event({
+            "type": "delete",
+            "elementId": element_id
+        }), exclude_client_id=client_id)
+        manager.mark_dirty()
+
+
+async def _handle_clear(envelope: Clear, client_id: str):
+    manager.clear_canvas()
+    manager.log_event({"op": "clear"})
+    manager.queue_broadcast(manager.record_event({
+        "type": "clear"
+    }), exclude_client_id=client_id)
+    manager.request_save()
+
+
+async def _handle_undo(envelope: Undo, client_id: str):
+    # Remove last element created by this client
+    element_id = manager.undo_for_client(client_id)
+    if element_id:
+        manager.log_event({"op": "delete", "id": element_id})
+        # Broadcast to all clients (including sender) to remove this element
+        message = manager.record_event({
+            "type": "undo",
+            "elementId": element_id
+        })
+        manager.queue_broadcast(message)
+        # Also send to the sender
+        manager.send_to(client_id, message)
+        manager.mark_dirty()
+
+
+HANDLERS = {
+    Draw: _handle_draw,
+    Laser: _handle_laser,
+    Delete: _handle_delete,
+    Clear: _handle_clear,
+    Undo: _handle_undo,
+}
+
+
+@app.get("/api/image/{name}")
+async def get_image(name: str):
+    # Names are hash.ext; reject anything path-like
+    if "/" in name or "\\" in name or ".." in name:
+        return Response(status_code=404)
+    path = IMAGES_DIR / name
+    if not path.is_file():
+        return Response(status_code=404)
+    # FileResponse streams via sendfile and sets the media type from the
+    # extension
+    return FileResponse(path)
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     client_id = await manager.connect(websocket)
-    
+    wire = manager.active_connections[client_id].wire
+    decoder = _mp_envelope_decoder if wire == "msgpack" else _envelope_decoder
+
     try:
         while True:
-            data = await websocket.receive_json()
-            
-            if data.get("type") == "draw":
-                # Validate and store the drawing event
-                try:
-                    draw_event = DrawEvent(**data.get("data", {}))
-                    manager.add_or_update_element(draw_event)
-                    
-                    # Broadcast to all other clients
-                    await manager.broadcast({
-                        "type": "draw",
-                        "data": draw_event.model_dump()
-                    }, exclude_client_id=client_id)
-                    
-                    # Schedule auto-save
-                    await manager.schedule_save()
-                    
-                except Exception as e:
-                    print(f"Error processing draw event: {e}")
-                    import traceback
-                    traceback.print_exc()
-            
-            elif data.get("type") == "laser":
-                # Handle laser events - broadcast but don't save
-                try:
-                    draw_event = DrawEvent(**data.get("data", {}))
-                    
-                    # Broadcast laser event to all other clients (not saved)
-                    await manager.broadcast({
-                        "type": "laser",
-                        "data": draw_event.model_dump()
-                    }, exclude_client_id=client_id)
-                    
-                    print(f"Broadcasting laser event from client {client_id}")
-                    
-                except Exception as e:
-                    print(f"Error processing laser event: {e}")
-                    import traceback
-                    traceback.print_exc()
-            
-            elif data.get("type") == "delete":
-                element_id = data.get("elementId")
-                if element_id:
-                    deleted = manager.delete_element(element_id)
-                    if deleted:
-                        await manager.broadcast({
-                            "type": "delete",
-                            "elementId": element_id
-                        }, exclude_client_id=client_id)
-                        await manager.schedule_save()
-            
-            elif data.get("type") == "clear":
-                manager.clear_canvas()
-                await manager.broadcast({
-                    "type": "clear"
-                }, exclude_client_id=client_id)
-                manager.save_state()
-            
-            elif data.get("type") == "undo":
-                # Remove last element created by this client
-                element_id = manager.undo_for_client(client_id)
-                if element_id:
-                    # Broadcast to all clients (including sender) to remove this element
-                    await manager.broadcast({
-                        "type": "undo",
-                        "elementId": element_id
-                    })
-                    # Also send to the sender
-                    await websocket.send_json({
-                        "type": "undo",
-                        "elementId": element_id
-                    })
-                    await manager.schedule_save()
-                    
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            raw = message["bytes"] if message.get("bytes") is not None else message["text"]
+
+            try:
+                envelope = decoder.decode(raw)
+            except (msgspec.DecodeError, msgspec.ValidationError) as e:
+                print(f"Error decoding message from {client_id}: {e}")
+                continue
+
+            try:
+                await HANDLERS[type(envelope)](envelope, client_id)
+            except Exception as e:
+                print(f"Error processing {type(envelope).__name__.lower()} event: {e}")
+                import traceback
+                traceback.print_exc()
+
     except WebSocketDisconnect:
         manager.disconnect(client_id)
     except Exception as e:
@@ -268,5 +783,8 @@ if __name__ == "__main__":
     print("\n🎨 FreeForm Whiteboard Server Starting...")
     print("📍 Server will be available at: http://localhost:8000")
     print("🌐 Access from local network at: http://<your-ip>:8000\n")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop's libuv-based event loop and httptools' C parser cut
+    # per-I/O overhead on the websocket-heavy workload
+    uvicorn.run(app, host="0.0.0.0", port=8000,
+                loop="uvloop", http="httptools", ws="websockets")
 
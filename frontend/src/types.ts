@@ -20,6 +20,7 @@ export interface DrawEvent {
   text?: string;
   fontSize?: number;
   imageData?: string;
+  imageRef?: string;
   imageWidth?: number;
   imageHeight?: number;
 }
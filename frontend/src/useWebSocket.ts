@@ -1,5 +1,43 @@
 import { useEffect, useRef, useState } from 'react';
-import { DrawEvent, CanvasState } from './types';
+import { DrawEvent, CanvasState, Point } from './types';
+
+// The wire format uses flat interleaved points [x0, y0, x1, y1, ...]
+// (half the JSON of {x, y} objects); the app keeps Point[] internally.
+const flattenPoints = (points: Point[]): number[] => {
+  const flat: number[] = new Array(points.length * 2);
+  for (let i = 0; i < points.length; i++) {
+    flat[i * 2] = points[i].x;
+    flat[i * 2 + 1] = points[i].y;
+  }
+  return flat;
+};
+
+const inflateEvent = (event: any, httpBase: string): any => {
+  if (event && Array.isArray(event.points) && typeof event.points[0] === 'number') {
+    const points: Point[] = [];
+    for (let i = 0; i + 1 < event.points.length; i += 2) {
+      points.push({ x: event.points[i], y: event.points[i + 1] });
+    }
+    event.points = points;
+  }
+  // Images are stored server-side and referenced by hash; an <img> src
+  // pointing at the image endpoint renders the same as a data URL
+  if (event && event.imageRef && !event.imageData) {
+    event.imageData = `${httpBase}/api/image/${event.imageRef}`;
+  }
+  return event;
+};
+
+const inflateMessage = (data: any, httpBase: string): any => {
+  if (data.data) {
+    if (Array.isArray(data.data.elements)) {
+      data.data.elements = data.data.elements.map((el: any) => inflateEvent(el, httpBase));
+    } else {
+      inflateEvent(data.data, httpBase);
+    }
+  }
+  return data;
+};
 
 export const useWebSocket = (url: string) => {
   const [isConnected, setIsConnected] = useState(false);
@@ -7,11 +45,23 @@ export const useWebSocket = (url: string) => {
   const [clientId, setClientId] = useState<string>('');
   const ws = useRef<WebSocket | null>(null);
   const messageHandlers = useRef<((data: any) => void)[]>([]);
+  const decoder = useRef(new TextDecoder());
+  // Last mutation seq seen plus the server epoch: echoed back on
+  // reconnect so the server can replay just the missed deltas
+  const lastSeq = useRef(0);
+  const epoch = useRef('');
+  // e.g. ws://host:8000/ws -> http://host:8000 for fetching image refs
+  const httpBase = url.replace(/^ws/, 'http').replace(/\/ws$/, '');
 
   useEffect(() => {
     const connect = () => {
       try {
-        ws.current = new WebSocket(url);
+        const wsUrl = epoch.current
+          ? `${url}?since=${lastSeq.current}&epoch=${epoch.current}`
+          : url;
+        ws.current = new WebSocket(wsUrl);
+        // Server sends binary frames (pre-serialized JSON bytes)
+        ws.current.binaryType = 'arraybuffer';
 
         ws.current.onopen = () => {
           console.log('WebSocket connected');
@@ -19,15 +69,27 @@ export const useWebSocket = (url: string) => {
         };
 
         ws.current.onmessage = (event) => {
-          const data = JSON.parse(event.data);
+          const text = typeof event.data === 'string'
+            ? event.data
+            : decoder.current.decode(event.data);
+          const data = inflateMessage(JSON.parse(text), httpBase);
           
           if (data.type === 'init') {
             setCanvasState(data.data);
-            // Store client ID from server
-            if (data.clientId) {
-              setClientId(data.clientId);
-            }
+            lastSeq.current = data.seq ?? 0;
+            epoch.current = data.epoch ?? '';
+          } else if (data.type === 'clientId') {
+            // Sent right after init; the snapshot itself is shared
+            setClientId(data.clientId);
+          } else if (data.type === 'batch') {
+            // Server coalesces rapid events into one frame
+            data.events.forEach((event: any) => {
+              inflateMessage(event, httpBase);
+              if (event.seq) lastSeq.current = event.seq;
+              messageHandlers.current.forEach(handler => handler(event));
+            });
           } else {
+            if (data.seq) lastSeq.current = data.seq;
             // Call all registered message handlers
             messageHandlers.current.forEach(handler => handler(data));
           }
@@ -65,11 +127,11 @@ export const useWebSocket = (url: string) => {
   };
 
   const sendDrawEvent = (event: DrawEvent) => {
-    // Add clientId to the event
-    const eventWithClientId = { ...event, clientId };
+    // Add clientId and flatten points for the wire
+    const wireEvent = { ...event, clientId, points: flattenPoints(event.points) };
     sendMessage({
       type: event.type === 'laser' || event.tool === 'laser' ? 'laser' : 'draw',
-      data: eventWithClientId
+      data: wireEvent
     });
   };
 